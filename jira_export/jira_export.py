@@ -1,17 +1,43 @@
+from __future__ import annotations
+
+import argparse
 import configparser
+import hashlib
+import json
+import os
 import re
+import shutil
 import socket
 import sys
-from dataclasses import dataclass
-from os import getcwd, mkdir, path
-
-import keyboard
-import pypandoc
-from jira import JIRA, client, resources
-from jira.exceptions import JIRAError
-from pdfkit import configuration, from_string
+from collections.abc import Callable, Iterator
+from concurrent.futures import Executor, Future, ProcessPoolExecutor
+from contextlib import ExitStack, nullcontext, redirect_stdout
+from dataclasses import dataclass, field, fields
+from glob import glob
+from os import getcwd, path
+from typing import NoReturn, TextIO
 
 SETTINGS_FILE = 'settings.ini'
+MANIFEST_FILE = 'manifest.json'
+ATTACHMENT_CHUNK_SIZE = 1024 * 1024
+ENV_PREFIX = 'JIRA_EXPORT_'
+# Comments are not requested with issues - they are fetched page by page when rendered
+ISSUE_FIELDS = '*all,-comment'
+COMMENTS_PAGE_SIZE = 50
+
+# Size of images in exported issues. Downscaled images for pdf are IMAGE_DERIVATIVE_SCALE times bigger to stay sharp when printed
+IMAGE_WIDTH = 300
+IMAGE_HEIGHT = 200
+IMAGE_DERIVATIVE_SCALE = 2
+IMAGE_DERIVATIVES_DIR = 'IMAGE_CACHE'
+OUTPUT_HASHES_DIR = 'OUTPUT_HASHES'
+IMG_PATTERN = re.compile(r'<img\s+[^>]*src="([^"]+)"[^>]*>')
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.gif', '.bmp', '.tif', '.tiff', '.webp')
+
+# Exit codes
+EXIT_OK = 0
+EXIT_ERROR = 1
+EXIT_PARTIAL = 2
 
 
 @dataclass
@@ -24,7 +50,89 @@ class Settings:
     export_path: str = 'EXPORT\\'
     save_to_html: bool = True
     save_to_pdf: bool = True
+    stream_issues: bool = False
+    wkhtmltopdf_path: str = ''
+    downscale_images: bool = True
+    skip_unchanged: bool = True
+    image_workers: int = 0
+    interactive: bool = True
+    progress_format: str = field(
+        default='text', metadata={'choices': ('text', 'json')})
     jira_project: str = 'TEST'
+    shard_index: int = 0
+    shard_count: int = 1
+
+
+@dataclass
+class ExportStats:
+    '''Class for storing number of exported and failed issues, and number of written and skipped (unchanged) html/pdf files.'''
+
+    exported: int = 0
+    failed: int = 0
+    written: int = 0
+    skipped: int = 0
+
+
+# jira, pypandoc, pdfkit and keyboard are slow to import, so they are imported on first use by functions below. Imported names are set as module globals, so they are used (and can be patched) as if imported at module level.
+
+def import_jira() -> None:
+    '''Imports jira on first use'''
+
+    global JIRA, JIRAError, client, resources
+    if 'JIRA' not in globals():
+        from jira import JIRA, client, resources
+        from jira.exceptions import JIRAError
+
+
+def import_pypandoc() -> None:
+    '''Imports pypandoc on first use'''
+
+    global pypandoc
+    if 'pypandoc' not in globals():
+        import pypandoc
+
+
+def import_pdfkit() -> None:
+    '''Imports pdfkit on first use'''
+
+    global configuration, from_file, from_string
+    if 'from_string' not in globals():
+        from pdfkit import configuration, from_file, from_string
+
+
+def import_keyboard() -> None:
+    '''Imports keyboard on first use'''
+
+    global keyboard
+    if 'keyboard' not in globals():
+        import keyboard
+
+
+def import_pillow() -> bool:
+    '''Imports Pillow on first use. Pillow is optional, returns False if it is not installed'''
+
+    global Image
+    if 'Image' not in globals():
+        try:
+            from PIL import Image
+        except ImportError:
+            return False
+    return True
+
+
+LAZY_IMPORTS = {'JIRA': import_jira, 'JIRAError': import_jira, 'client': import_jira, 'resources': import_jira,
+                'pypandoc': import_pypandoc,
+                'configuration': import_pdfkit, 'from_file': import_pdfkit, 'from_string': import_pdfkit,
+                'keyboard': import_keyboard}
+
+
+def __getattr__(name: str):
+    '''Imports lazily imported names when accessed as module attributes'''
+
+    if name in LAZY_IMPORTS:
+        LAZY_IMPORTS[name]()
+        return globals()[name]
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
 
 
 def is_server_reachable(server_url: str) -> None:
@@ -35,8 +143,16 @@ def is_server_reachable(server_url: str) -> None:
     socket.gethostbyname(hostname)
 
 
-def validate_settings(config: configparser.ConfigParser) -> configparser.ConfigParser:
-    '''Validates settings.ini (loaded ConfigParser object), checks if all required fields are present, add missing entries and returns ConfigParser object'''
+# Options which might be missing in settings.ini without updating it
+OPTIONAL_SETTINGS = {'EXPORT_OPTIONS': ['stream_issues', 'wkhtmltopdf_path', 'downscale_images', 'skip_unchanged',
+                                        'image_workers', 'interactive', 'progress_format'],
+                     'SHARDING': ['shard_index', 'shard_count']}
+
+
+def validate_settings(config: configparser.ConfigParser, settings_file: str = SETTINGS_FILE, update_file: bool = True) -> configparser.ConfigParser:
+    '''Validates settings.ini (loaded ConfigParser object), checks if all required fields are present, add missing entries and returns ConfigParser object.
+
+    If update_file is False settings file is never rewritten - missing entries get default values and incorrect values raise configparser.Error'''
 
     # Creating default settings structure
     settings = Settings()
@@ -73,13 +189,16 @@ def validate_settings(config: configparser.ConfigParser) -> configparser.ConfigP
         try:
             config.getboolean(section, opt)
         except ValueError:
+            if not update_file:
+                raise configparser.Error(
+                    f'Incorrect value of {opt}: {config.get(section, opt)} (section {section})')
             config.set(section, opt,
                        config_default.get(section, opt))
             settings_changed = True
 
     # Notifications if settings changed -> exit program
-    if settings_changed:
-        with open(SETTINGS_FILE, "w") as save_stream:
+    if settings_changed and update_file:
+        with open(settings_file, "w") as save_stream:
             config.write(save_stream)
         raise ValueError
     return config
@@ -96,22 +215,114 @@ def load_settings_to_dataclass(config: configparser.ConfigParser) -> Settings:
     settings.save_to_html = config.getboolean('EXPORT_OPTIONS', 'save_to_html')
     settings.save_to_pdf = config.getboolean('EXPORT_OPTIONS', 'save_to_pdf')
     settings.jira_project = config.get('ISSUE_FILTER', 'jira_project')
+
+    # Optional settings keep default values if missing. Sharding is optional - missing section means single process export of whole project
+    for section, options in OPTIONAL_SETTINGS.items():
+        for option in options:
+            if config.has_option(section, option):
+                try:
+                    value = parse_setting(option, config.get(section, option))
+                except ValueError as e:
+                    raise configparser.Error(f'{e} (section {section})')
+                setattr(settings, option, value)
     return settings
 
 
-def load_settings() -> Settings:
+def validate_shard(shard_index: int, shard_count: int) -> None:
+    '''Validates sharding options. Raises ValueError if shard_index is not in range 0..shard_count-1'''
+
+    if shard_count < 1 or not 0 <= shard_index < shard_count:
+        raise ValueError(
+            f'Incorrect sharding options: shard_index={shard_index}, shard_count={shard_count}')
+
+
+def validate_image_workers(image_workers: int) -> None:
+    '''Validates number of image processes. Raises ValueError if image_workers is negative (0 means number of CPUs)'''
+
+    if image_workers < 0:
+        raise ValueError(
+            f'Incorrect value of image_workers: {image_workers} (0 - number of CPUs or positive number of processes)')
+
+
+def load_settings(settings_file: str = SETTINGS_FILE, update_file: bool = True) -> Settings:
     '''Loads settings.ini from file, validates it and returns Settings object'''
 
     config = configparser.ConfigParser()
-    config.read(SETTINGS_FILE)
-    config = validate_settings(config)
+    config.read(settings_file)
+    config = validate_settings(config, settings_file, update_file)
     settings = load_settings_to_dataclass(config)
     return settings
 
 
+def parse_setting(name: str, value: str) -> bool | int | str:
+    '''Converts str value (e.g. from environment variable) to type of Settings field. Raises ValueError for incorrect value'''
+
+    settings_field = next(f for f in fields(Settings) if f.name == name)
+    if settings_field.type == 'bool':
+        if value.lower() not in configparser.ConfigParser.BOOLEAN_STATES:
+            raise ValueError(f'Incorrect value of {name}: {value}')
+        return configparser.ConfigParser.BOOLEAN_STATES[value.lower()]
+    if settings_field.type == 'int':
+        try:
+            return int(value)
+        except ValueError:
+            raise ValueError(f'Incorrect value of {name}: {value}')
+    choices = settings_field.metadata.get('choices')
+    if choices and value not in choices:
+        raise ValueError(f'Incorrect value of {name}: {value}')
+    return value
+
+
+class ArgumentParser(argparse.ArgumentParser):
+    '''ArgumentParser exiting with EXIT_ERROR on usage errors, so they are not mistaken for EXIT_PARTIAL (argparse uses 2 by default)'''
+
+    def error(self, message: str) -> NoReturn:
+        self.print_usage(sys.stderr)
+        self.exit(EXIT_ERROR, f'{self.prog}: error: {message}\n')
+
+
+def parse_args(argv: list[str] | None = None) -> argparse.Namespace:
+    '''Parses command line arguments. There is option for every Settings field, not provided options are None'''
+
+    parser = ArgumentParser(
+        prog='jira_export',
+        description='Small program for exporting issues from Jira to pdf or html.',
+        epilog=f'Every option can be also set by environment variable {ENV_PREFIX}<OPTION>, e.g. {ENV_PREFIX}JIRA_PROJECT. Command line options take precedence over environment variables, which take precedence over settings file. '
+        f'Exit codes: {EXIT_OK} - all issues exported, {EXIT_ERROR} - error (settings, connection), {EXIT_PARTIAL} - some issues failed to export.')
+    parser.add_argument('--settings', default=SETTINGS_FILE,
+                        help=f'path to settings file (default: {SETTINGS_FILE})')
+    parser.add_argument('--merge-manifests', nargs='+', metavar='DIR',
+                        help=f'only merge shard manifests found in DIRs into {MANIFEST_FILE} in first DIR and exit. Run after all shards finished')
+    for settings_field in fields(Settings):
+        option = f"--{settings_field.name.replace('_', '-')}"
+        if settings_field.type == 'bool':
+            parser.add_argument(
+                option, action=argparse.BooleanOptionalAction, default=None)
+        else:
+            parser.add_argument(option, type=int if settings_field.type == 'int' else str,
+                                choices=settings_field.metadata.get('choices'), default=None)
+    return parser.parse_args(argv)
+
+
+def settings_overrides(args: argparse.Namespace, environ: dict) -> dict:
+    '''Returns dict of Settings fields overridden by command line arguments or environment variables'''
+
+    overrides = {}
+    for settings_field in fields(Settings):
+        value = getattr(args, settings_field.name)
+        if value is None:
+            env_value = environ.get(f'{ENV_PREFIX}{settings_field.name.upper()}')
+            if env_value is None:
+                continue
+            value = parse_setting(settings_field.name, env_value)
+        overrides[settings_field.name] = value
+    return overrides
+
+
 def authenticate_jira(jira_url: str, jira_username: str, jira_api_token: str) -> JIRA:
     '''Set up JIRA object. Others method of authentication left commented (They are not tested)'''
 
+    import_jira()
     is_server_reachable(jira_url)
     jira = JIRA(
         server=jira_url,
@@ -125,31 +336,205 @@ def authenticate_jira(jira_url: str, jira_username: str, jira_api_token: str) ->
     return jira
 
 
-def find_issues(jira_project_key: str, jira: JIRA, start_at: int, max_results: int) -> client.ResultList:
-    '''Returns jira.client.ResultList based on provided JIRA instance and jQL containing Project key'''
+def find_issues(jira_project_key: str, jira: JIRA, start_at: int, max_results: int, fields: str = ISSUE_FIELDS) -> client.ResultList:
+    '''Returns jira.client.ResultList based on provided JIRA instance and jQL containing Project key. Issues are ordered by id, so paging is stable'''
 
     result_list = jira.search_issues(
-        f'project={jira_project_key}', startAt=start_at, maxResults=max_results)
+        f'project={jira_project_key} ORDER BY id', startAt=start_at, maxResults=max_results, fields=fields)
     return result_list
 
 
-def generate_pdf_from_html_string(html_content: str, jira_issue_key: resources.Issue, path_exp: str) -> None:
-    '''Uses pdfkit to generate pdf to EXPORT_PATH from provided html_content string'''
+def find_shard_issues(result_list: client.ResultList, jira: JIRA, shard_index: int, shard_count: int) -> client.ResultList | list:
+    '''Returns full issues belonging to shard from page of issues found with only id field, so every shard downloads only its own issues'''
+
+    issue_ids = [issue.id for issue in result_list
+                 if is_issue_in_shard(issue.id, shard_index, shard_count)]
+    if not issue_ids:
+        return []
+    return jira.search_issues(f"id in ({','.join(issue_ids)}) ORDER BY id",
+                              startAt=0, maxResults=len(issue_ids), fields=ISSUE_FIELDS)
+
+
+def is_issue_in_shard(issue_id: str, shard_index: int, shard_count: int) -> bool:
+    '''Checks if issue belongs to shard. Issues are split deterministically by numeric Jira issue id, so every shard exports disjoint slice of project'''
+
+    return int(issue_id) % shard_count == shard_index
+
+
+def manifest_filename(shard_index: int, shard_count: int) -> str:
+    '''Returns filename of manifest written by single shard'''
+
+    return f'manifest-shard-{shard_index}-of-{shard_count}.jsonl'
+
+
+def load_manifest(file_path: str) -> dict:
+    '''Loads shard manifest (json lines: header, one line per exported issue, finished marker). Last line which is not fully written yet by running shard is ignored'''
+
+    manifest = {'issues': {}, 'finished': False}
+    with open(file_path, encoding='utf-8') as load_stream:
+        for line in load_stream:
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                break
+            if 'key' in entry:
+                manifest['issues'][entry['key']] = {
+                    'id': entry['id'], 'files': entry['files']}
+            else:
+                manifest.update(entry)
+    return manifest
+
+
+def find_manifests(source_paths: list[str], shard_count: int | str = '*') -> list[str]:
+    '''Returns sorted paths of shard manifests found in source_paths. Without shard_count manifests written with any shard_count are returned'''
+
+    return sorted(file_path for source_path in source_paths
+                  for file_path in glob(path.join(source_path, manifest_filename('*', shard_count))))
+
+
+def find_manifests_shard_count(source_paths: list[str]) -> int:
+    '''Returns shard_count of shard manifests found in source_paths. Raises ValueError if there are no manifests or they were written with different shard_count'''
+
+    shard_counts = {load_manifest(file_path).get('shard_count') for file_path in find_manifests(source_paths)}
+    shard_counts.discard(None)
+    if len(shard_counts) != 1:
+        raise ValueError(
+            f'Cannot determine shard_count of manifests in {", ".join(source_paths)} (found: {sorted(shard_counts)}). Provide it with --shard-count')
+    return shard_counts.pop()
+
+
+def merge_manifests(path_exp: str, shard_count: int, source_paths: list[str] | None = None) -> dict:
+    '''Combines manifests of all shards found in path_exp into MANIFEST_FILE. Manifests written with different shard_count are ignored. Returns merged manifest
+
+    If source_paths are provided (e.g. export folders of shards running on separate hosts), manifests are read from them and merged MANIFEST_FILE is written to path_exp'''
+
+    merged = {'shard_count': shard_count, 'shards': [], 'issues': {}}
+    for file_path in find_manifests(source_paths or [path_exp], shard_count):
+        manifest = load_manifest(file_path)
+        # Shard which just started might not have written its header yet
+        if 'jira_project' not in manifest:
+            continue
+        merged['jira_project'] = manifest['jira_project']
+        if manifest['finished']:
+            merged['shards'].append(manifest['shard_index'])
+        merged['issues'].update(manifest['issues'])
+    merged['shards'].sort()
+    merged['complete'] = merged['shards'] == list(range(shard_count))
+
+    # Written to temporary file first and then replaced, so other shards never read half written manifest. Unchanged manifest is not replaced
+    file_path = path.join(path_exp, MANIFEST_FILE)
+    manifest_str = json.dumps(merged, indent=2, sort_keys=True)
+    try:
+        with open(file_path, encoding='utf-8') as load_stream:
+            if load_stream.read() == manifest_str:
+                return merged
+    except OSError:
+        pass
+    temp_path = f'{file_path}.{os.getpid()}.tmp'
+    with open(temp_path, 'w', encoding='utf-8') as save_stream:
+        save_stream.write(manifest_str)
+    os.replace(temp_path, file_path)
+    return merged
 
-    options = {
+
+def pdf_options(path_exp: str) -> dict:
+    '''Returns wkhtmltopdf options used for generating pdf to EXPORT_PATH'''
+
+    return {
         'enable-local-file-access': True,
         'keep-relative-links': True,
         'allow': path.join(getcwd(), path_exp),
         'cache-dir': path.join(getcwd(), path_exp),
         'encoding': 'utf-8',
     }
+
+
+def output_hash_path(file_path: str) -> str:
+    '''Returns path of sidecar file with content hash of output file. Sidecar files are stored in OUTPUT_HASHES_DIR next to output file'''
+
+    return path.join(path.dirname(file_path), OUTPUT_HASHES_DIR, f'{path.basename(file_path)}.sha256')
+
+
+def is_output_unchanged(file_path: str, content_hash: str) -> bool:
+    '''Checks if output file exists and was generated from content with the same hash'''
+
+    try:
+        with open(output_hash_path(file_path), encoding='utf-8') as load_stream:
+            return path.isfile(file_path) and load_stream.read() == content_hash
+    except OSError:
+        return False
+
+
+def save_output_hash(file_path: str, content_hash: str) -> None:
+    '''Saves content hash of written output file to its sidecar file. Must be called after every write of output file - if content_hash is empty (skip_unchanged is off) sidecar file is removed, so stale hash never marks rewritten file as unchanged'''
+
+    hash_path = output_hash_path(file_path)
+    if not content_hash:
+        if path.exists(hash_path):
+            os.remove(hash_path)
+        return
+    os.makedirs(path.dirname(hash_path), exist_ok=True)
+    with open(hash_path, 'w', encoding='utf-8') as save_stream:
+        save_stream.write(content_hash)
+
+
+def update_pdf_hash(digest: hashlib._Hash, html_str: str) -> None:
+    '''Updates hash of pdf source with html content and content of local images it links, so pdf is generated again also when only image changed'''
+
+    digest.update(html_str.encode('utf-8'))
+    for img_src in IMG_PATTERN.findall(html_str):
+        if path.isfile(img_src):
+            digest.update(file_hash(img_src).encode('utf-8'))
+
+
+def generate_pdf_from_html_string(html_content: str, jira_issue_key: resources.Issue, path_exp: str, wkhtmltopdf_path: str = '', skip_unchanged: bool = False) -> bool:
+    '''Uses pdfkit to generate pdf to EXPORT_PATH from provided html_content string. If wkhtmltopdf_path is empty, pdfkit searches for wkhtmltopdf itself.
+
+    With skip_unchanged pdf is not generated if html_content and linked images did not change since pdf was generated. Returns False if pdf was skipped. If wkhtmltopdf fails, -ERROR.pdf file is written and IOError is raised'''
+
+    file_path = path.join(path_exp, f"{jira_issue_key}.pdf")
+    content_hash = ''
+    if skip_unchanged:
+        digest = hashlib.sha256()
+        update_pdf_hash(digest, html_content)
+        content_hash = digest.hexdigest()
+        if is_output_unchanged(file_path, content_hash):
+            return False
+
+    import_pdfkit()
     # Validation of any errors that migth come from wkhtmltopdf. Current known issue if there are incorrect links in <img> - might happen if someone used Jira markup as plain text which is converted incorrectly to html markup
     try:
         from_string(
-            html_content, path.join(path_exp, f"{jira_issue_key}.pdf"), options=options)
+            html_content, file_path, options=pdf_options(path_exp), configuration=configuration(wkhtmltopdf=wkhtmltopdf_path))
     except IOError:
         with open(path.join(path_exp, f"{jira_issue_key}-ERROR.pdf"), "w") as save_stream:
             save_stream.write("ERROR")
+        raise
+
+    save_output_hash(file_path, content_hash)
+    return True
+
+
+def generate_pdf_from_html_file(html_file_path: str, jira_issue_key: resources.Issue, path_exp: str, wkhtmltopdf_path: str = '', content_hash: str = '') -> bool:
+    '''Uses pdfkit to generate pdf to EXPORT_PATH from html file, so html content does not have to be kept in memory.
+
+    If content_hash of html file (see update_pdf_hash) is provided, pdf is not generated if it did not change since pdf was generated. Returns False if pdf was skipped. If wkhtmltopdf fails, -ERROR.pdf file is written and IOError is raised'''
+
+    file_path = path.join(path_exp, f"{jira_issue_key}.pdf")
+    if content_hash and is_output_unchanged(file_path, content_hash):
+        return False
+
+    import_pdfkit()
+    try:
+        from_file(
+            html_file_path, file_path, options=pdf_options(path_exp), configuration=configuration(wkhtmltopdf=wkhtmltopdf_path))
+    except IOError:
+        with open(path.join(path_exp, f"{jira_issue_key}-ERROR.pdf"), "w") as save_stream:
+            save_stream.write("ERROR")
+        raise
+
+    save_output_hash(file_path, content_hash)
+    return True
 
 
 def populate_html_fields(jira_issue: resources.Issue) -> str:
@@ -164,28 +549,45 @@ def populate_html_fields(jira_issue: resources.Issue) -> str:
     return html_content
 
 
+def iter_html_comments(jira_issue: resources.Issue, jira: JIRA) -> Iterator[str]:
+    '''Yields html formatted Comments from JIRA (Created, Author, Comment body) one by one. Comments are requested in pages of COMMENTS_PAGE_SIZE, so only one page is kept in memory. Markup from Jira converted by pypandoc'''
+    yield f'<h3>COMMENTS:</h3>'
+    start_at = 0
+    while True:
+        # Public JIRA.comments() of pinned jira 3.5.2 has no start_at/max_results and does not expose total, so it always loads all comments. Paged REST endpoint /issue/{key}/comment is requested by _get_json instead
+        page = jira._get_json(f'issue/{jira_issue}/comment',
+                              params={'startAt': start_at, 'maxResults': COMMENTS_PAGE_SIZE})
+        comments = page['comments']
+        for c in comments:
+            comment_body = convert_jira_wiki_markup(c['body'])
+            author = c.get('author', {}).get('displayName', '')
+            yield f"{c['created']} <br> {author} <br>{comment_body} <br>"
+        start_at += len(comments)
+        if not comments or start_at >= page['total']:
+            break
+
+
 def populate_html_comments(html_content: str, jira_issue: resources.Issue, jira: JIRA) -> str:
     ''' Appending Comments from JIRA (Created, Author, Comment body) to html formatted str.  Markup from Jira converted by pypandoc'''
-    html_content += f'<h3>COMMENTS:</h3>'
-    for c in jira_issue.fields.comment.comments:
-        html_content += f'{jira.comment(jira_issue,c).created} <br> '
-        html_content += f'{jira.comment(jira_issue,c).author.displayName} <br>'
-        comment_body_raw = jira.comment(jira_issue, c).body
-        comment_body = convert_jira_wiki_markup(comment_body_raw)
-        html_content += f'{comment_body} <br>'
-    return html_content
+    return html_content + ''.join(iter_html_comments(jira_issue, jira))
+
+
+def iter_html_attachments(attachments: list[str]) -> Iterator[str]:
+    '''Yields html links with attachments one by one. Uses list of attachment.'''
+    yield f'<h3>ATTACHMENTS:</h3>'
+    for a in attachments:
+        yield f'<a href="{a}">{a}</a><br>'
 
 
 def populate_html_attachments(html_content: str, attachments: list[str]) -> str:
     '''Append links with attachments to html formatted str. Uses list of attachment.'''
-    html_content += f'<h3>ATTACHMENTS:</h3>'
-    for a in attachments:
-        html_content += f'<a href="{a}">{a}</a><br>'
-    return html_content
+    return html_content + ''.join(iter_html_attachments(attachments))
 
 
-def download_attachments(jira_issue: resources.Issue, path_exp: str) -> list[str]:
-    '''Downloads attachment to EXPORT_PATH and returns list of filenames'''
+def download_attachments(jira_issue: resources.Issue, path_exp: str, skip_unchanged: bool = False) -> list[str]:
+    '''Downloads attachment to EXPORT_PATH in chunks and returns list of filenames.
+
+    With skip_unchanged attachment is not downloaded again if file was already downloaded from the same Jira attachment (attachments in Jira are never modified - new upload gets new id)'''
 
     attachments = []
     for a in jira_issue.fields.attachment:
@@ -193,27 +595,42 @@ def download_attachments(jira_issue: resources.Issue, path_exp: str) -> list[str
             filename = f'{jira_issue}-{a.filename}'
             filepath = path.join(path_exp, filename)
             attachments.append(filename)
+            content_hash = ''
+            if skip_unchanged:
+                content_hash = f'attachment-{a.id}-{a.size}'
+                if is_output_unchanged(filepath, content_hash) and path.getsize(filepath) == a.size:
+                    continue
             with open(filepath, 'wb') as save_stream:
-                save_stream.write(a.get())
+                save_stream.writelines(a.iter_content(ATTACHMENT_CHUNK_SIZE))
+            save_output_hash(filepath, content_hash)
             print(f'Attachment: {a} for issue {jira_issue} downloaded')
         except OSError:
             with open(path.join(path_exp, f'{jira_issue}-ATT_ERROR'), 'wb') as save_stream:
-                save_stream.write(a.get())
+                save_stream.writelines(a.iter_content(ATTACHMENT_CHUNK_SIZE))
     return attachments
 
 
 def convert_jira_wiki_markup(html_content: str) -> str:
     '''Uses pypandoc to convert JIRA markups to HTML'''
 
+    import_pypandoc()
     return pypandoc.convert_text(html_content, 'html', format='jira')
 
 
-def save_to_html(html_content: str, filename: str, path_exp: str) -> None:
-    '''Save html formatted str to path_exp\\filename'''
+def save_to_html(html_content: str, filename: str, path_exp: str, skip_unchanged: bool = False) -> bool:
+    '''Save html formatted str to path_exp\\filename. With skip_unchanged file is not written if it already has the same content. Returns False if file was skipped'''
 
     file_path = path.join(path_exp, f'{filename}.html')
+    content_hash = ''
+    if skip_unchanged:
+        content_hash = hashlib.sha256(html_content.encode('utf-8')).hexdigest()
+        if is_output_unchanged(file_path, content_hash):
+            return False
+
     with open(file_path, 'w', encoding='utf-8') as save_stream:
         save_stream.write(html_content)
+    save_output_hash(file_path, content_hash)
+    return True
 
 
 def validate_export_path(path_exp: str) -> None:
@@ -224,97 +641,355 @@ def validate_export_path(path_exp: str) -> None:
             raise FileExistsError
 
     else:
-        mkdir(path_exp)
+        # exist_ok - folder might be created in the meantime by other export running concurrently
+        os.makedirs(path_exp, exist_ok=True)
         print(f'Created export folder {path_exp}')
 
 
-def populate_html(issue: resources.Issue, path_exp: str, jira: JIRA) -> str:
-    '''Creates and populates str with html formatted content from JIRA fields. returns str '''
+def iter_html(issue: resources.Issue, attachments: list[str], jira: JIRA) -> Iterator[str]:
+    '''Yields html formatted content from JIRA fields, comments and list of downloaded attachments part by part. Every part contains only complete html tags'''
 
-    attachments = download_attachments(issue, path_exp)
-    html_content = populate_html_fields(issue)
-    html_content = populate_html_comments(html_content, issue, jira)
-    html_content = populate_html_attachments(html_content, attachments)
-    return html_content
+    yield populate_html_fields(issue)
+    yield from iter_html_comments(issue, jira)
+    yield from iter_html_attachments(attachments)
+
+
+def populate_html(issue: resources.Issue, attachments: list[str], jira: JIRA) -> str:
+    '''Creates and populates str with html formatted content from JIRA fields and list of downloaded attachments. returns str '''
 
+    return ''.join(iter_html(issue, attachments, jira))
 
-def convert_relative_to_absolute(html_str: str, path_exp: str, issue: resources.Issue, relative: bool) -> str:
+
+def export_issue_streamed(issue: resources.Issue, attachments: list[str], settings: Settings, jira: JIRA, derivatives: dict[str, str] | None = None, stats: ExportStats | None = None) -> None:
+    '''Writes html and pdf source of issue part by part, so only one comment is rendered in memory at the time. Pdf is generated from temporary html file which is removed afterwards.
+
+    Html is written to temporary file too and with skip_unchanged setting unchanged html/pdf are not replaced'''
+
+    html_path = path.join(settings.export_path, f'{issue}.html')
+    html_temp_path = f'{html_path}.{os.getpid()}.tmp'
+    pdf_source_path = path.join(
+        settings.export_path, f'{issue}-PDF_SOURCE.html')
+    html_digest = hashlib.sha256()
+    pdf_digest = hashlib.sha256()
+    # Temporary files are removed also when export fails (e.g. pandoc or wkhtmltopdf error)
+    try:
+        with ExitStack() as stack:
+            html_stream = pdf_stream = None
+            if settings.save_to_html:
+                html_stream = stack.enter_context(
+                    open(html_temp_path, 'w', encoding='utf-8'))
+            if settings.save_to_pdf:
+                pdf_stream = stack.enter_context(
+                    open(pdf_source_path, 'w', encoding='utf-8'))
+
+            for html_part in iter_html(issue, attachments, jira):
+                if html_stream:
+                    html_part_html = convert_relative_to_absolute(
+                        html_part, settings.export_path, issue, True)
+                    html_stream.write(html_part_html)
+                    html_digest.update(html_part_html.encode('utf-8'))
+                if pdf_stream:
+                    html_part_pdf = convert_relative_to_absolute(
+                        html_part, settings.export_path, issue, False, derivatives)
+                    pdf_stream.write(html_part_pdf)
+                    update_pdf_hash(pdf_digest, html_part_pdf)
+
+        if settings.save_to_html:
+            written = not (settings.skip_unchanged and is_output_unchanged(
+                html_path, html_digest.hexdigest()))
+            if written:
+                os.replace(html_temp_path, html_path)
+                save_output_hash(
+                    html_path, html_digest.hexdigest() if settings.skip_unchanged else '')
+            count_output(stats, written)
+
+        if settings.save_to_pdf:
+            written = generate_pdf_from_html_file(
+                pdf_source_path, issue, settings.export_path, settings.wkhtmltopdf_path,
+                pdf_digest.hexdigest() if settings.skip_unchanged else '')
+            count_output(stats, written)
+    finally:
+        for temp_path in (html_temp_path, pdf_source_path):
+            if path.exists(temp_path):
+                os.remove(temp_path)
+
+
+def count_output(stats: ExportStats | None, written: bool) -> None:
+    '''Counts written or skipped (unchanged) output file in stats'''
+
+    if stats is None:
+        return
+    if written:
+        stats.written += 1
+    else:
+        stats.skipped += 1
+
+
+def consume_issues(result_list: client.ResultList) -> Iterator[resources.Issue]:
+    '''Yields issues from result list removing them from it, so every issue can be released right after it is processed'''
+
+    result_list.reverse()
+    while result_list:
+        yield result_list.pop()
+
+
+def convert_relative_to_absolute(html_str: str, path_exp: str, issue: resources.Issue, relative: bool, derivatives: dict[str, str] | None = None) -> str:
     '''Convert image links in html formatted str from relative path to absolute paths. Needed for properly saving pdf with images by pdfkit. As a PATH it uses export path defined in settings.ini.
 
-    Additionally adding Jira issue number to links.
+    Additionally adding Jira issue number to links. For absolute links images found in derivatives (attachment filename -> path of downscaled image) are replaced by downscaled ones.
 
     Images are resized to width="300" height="200" '''
 
     # Get the current working directory
     current_directory = path.join(getcwd(), path_exp)
 
-    # Define a regular expression pattern to match image tags
-    img_pattern = re.compile(r'<img\s+[^>]*src="([^"]+)"[^>]*>')
-
     # Replace relative image links with absolute paths depending on relative switch. Add issue number to filename
     def replace_img(match):
         img_src = match.group(1)
         if not img_src.startswith(('http://', 'https://', 'file://')):
             if relative:
                 abs_img_src = f'{issue}-{img_src}'
+            elif derivatives and f'{issue}-{img_src}' in derivatives:
+                abs_img_src = path.abspath(derivatives[f'{issue}-{img_src}'])
             else:
                 abs_img_src = path.abspath(
                     path.join(current_directory, f'{issue}-{img_src}'))
 
             # migth provide later settings to change size of images
-            return f'<img src="{abs_img_src}" width="300" height="200">'
+            return f'<img src="{abs_img_src}" width="{IMAGE_WIDTH}" height="{IMAGE_HEIGHT}">'
         return match.group(0)
 
     # Use the regular expression pattern to find and replace image tags
-    modified_html = img_pattern.sub(replace_img, html_str)
+    modified_html = IMG_PATTERN.sub(replace_img, html_str)
 
     return modified_html
 
 
-def validate_wkhtmltopdf_exists():
-    '''Checks if wkhtmltopdf is installed and if not raises OSError'''
+def file_hash(file_path: str) -> str:
+    '''Returns sha256 hex digest of file content. File is read in chunks'''
+
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as load_stream:
+        for chunk in iter(lambda: load_stream.read(ATTACHMENT_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def create_image_derivative(source_path: str, derivatives_dir: str) -> str | None:
+    '''Creates downscaled and recompressed copy of image, fitting in displayed size (times IMAGE_DERIVATIVE_SCALE). Copies are named by hash of source, so unchanged images are never processed again.
+
+    Returns path of downscaled image or None if image is already small enough or cannot be read. Runs in worker process'''
+
+    width = IMAGE_WIDTH * IMAGE_DERIVATIVE_SCALE
+    height = IMAGE_HEIGHT * IMAGE_DERIVATIVE_SCALE
+    import_pillow()
+    try:
+        name = f'{file_hash(source_path)}-{width}x{height}'
+        for extension in ('.jpg', '.png'):
+            if path.isfile(path.join(derivatives_dir, name + extension)):
+                return path.join(derivatives_dir, name + extension)
+
+        with Image.open(source_path) as image:
+            if image.width <= width and image.height <= height:
+                return None
+            # Decoding JPEG at reduced scale is much faster than decoding full resolution
+            image.draft('RGB', (width, height))
+            image.thumbnail((width, height))
+            if image.mode in ('RGBA', 'LA') or 'transparency' in image.info:
+                derivative_path = path.join(derivatives_dir, name + '.png')
+                save_options = {'format': 'PNG', 'optimize': True}
+            else:
+                image = image.convert('RGB')
+                derivative_path = path.join(derivatives_dir, name + '.jpg')
+                save_options = {'format': 'JPEG',
+                                'quality': 85, 'optimize': True}
+
+            # Written to temporary file first, so other export processes never use half written image
+            temp_path = f'{derivative_path}.{os.getpid()}.tmp'
+            image.save(temp_path, **save_options)
+            os.replace(temp_path, derivative_path)
+    except (OSError, Image.DecompressionBombError):
+        return None
+    return derivative_path
+
+
+def submit_image_derivatives(attachments: list[str], path_exp: str, pool: Executor) -> dict[str, Future]:
+    '''Submits creation of downscaled copies of image attachments in IMAGE_DERIVATIVES_DIR to process pool without waiting for them. Returns dict attachment filename -> future of create_image_derivative'''
+
+    derivatives_dir = path.join(path_exp, IMAGE_DERIVATIVES_DIR)
+    os.makedirs(derivatives_dir, exist_ok=True)
+    return {a: pool.submit(create_image_derivative, path.join(path_exp, a), derivatives_dir)
+            for a in attachments if path.splitext(a)[1].lower() in IMAGE_EXTENSIONS}
+
+
+def collect_image_derivatives(futures: dict[str, Future]) -> dict[str, str]:
+    '''Waits for submitted image derivatives. Returns dict attachment filename -> path of downscaled image'''
+
+    derivatives = {image: future.result() for image, future in futures.items()}
+    return {image: derivative_path for image, derivative_path in derivatives.items() if derivative_path}
 
-    config = configuration()
 
+def create_image_derivatives(attachments: list[str], path_exp: str, pool: Executor) -> dict[str, str]:
+    '''Creates downscaled copies of image attachments in IMAGE_DERIVATIVES_DIR on process pool. Returns dict attachment filename -> path of downscaled image'''
 
-def validate_pandoc_exists():
-    '''Checks if pandoc is installed and if not raises OSError'''
+    return collect_image_derivatives(submit_image_derivatives(attachments, path_exp, pool))
 
+
+def validate_wkhtmltopdf_exists(wkhtmltopdf_path: str = '') -> str:
+    '''Checks if wkhtmltopdf is installed (or if provided wkhtmltopdf_path is executable file) and if not raises OSError. Returns path to wkhtmltopdf'''
+
+    if wkhtmltopdf_path:
+        if not (path.isfile(wkhtmltopdf_path) and os.access(wkhtmltopdf_path, os.X_OK)):
+            raise OSError(
+                f'wkhtmltopdf_path is not executable file: {wkhtmltopdf_path}')
+        return wkhtmltopdf_path
+
+    wkhtmltopdf_path = shutil.which('wkhtmltopdf')
+    if not wkhtmltopdf_path:
+        raise OSError('No wkhtmltopdf executable found')
+    return wkhtmltopdf_path
+
+
+def validate_pandoc_exists() -> str:
+    '''Checks if pandoc is installed and if not raises OSError. Returns path to pandoc'''
+
+    import_pypandoc()
     pypandoc.get_pandoc_version()
+    pandoc_path = pypandoc.get_pandoc_path()
+    return shutil.which(pandoc_path) or pandoc_path
+
 
+def toolchain_cache_path() -> str:
+    '''Returns path of file with toolchain probes cached between runs'''
 
-def initial_setup() -> Settings:
-    '''Initial setup of program. Checks and creates settings.ini file with default values and validates if wkhtmltopdf and pandoc are installed. Returns settings object'''
+    cache_dir = os.environ.get(
+        'XDG_CACHE_HOME', path.join(path.expanduser('~'), '.cache'))
+    return path.join(cache_dir, 'jira_export', 'toolchain.json')
+
+
+def load_toolchain_cache() -> dict:
+    '''Loads toolchain cache. Returns empty dict if cache does not exist or is damaged'''
 
     try:
-        settings = load_settings()
+        with open(toolchain_cache_path(), encoding='utf-8') as load_stream:
+            return json.load(load_stream)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_toolchain_cache(cache: dict) -> None:
+    '''Saves toolchain cache. Cache is only an optimization, so errors (e.g. read only home directory) are ignored'''
+
+    cache_path = toolchain_cache_path()
+    try:
+        os.makedirs(path.dirname(cache_path), exist_ok=True)
+        temp_path = f'{cache_path}.{os.getpid()}.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as save_stream:
+            json.dump(cache, save_stream, indent=2)
+        os.replace(temp_path, cache_path)
+    except OSError:
+        pass
+
+
+def probe_toolchain(tool: str, validate: Callable[[], str], cache: dict) -> str:
+    '''Returns path to tool found by validate function (which raises OSError if tool is missing). Path found in previous run is returned without running validate if binary was not modified since then (same path and mtime)'''
+
+    entry = cache.get(tool)
+    if entry:
+        try:
+            if path.getmtime(entry['path']) == entry['mtime']:
+                return entry['path']
+        except OSError:
+            pass
+
+    tool_path = validate()
+    cache[tool] = {'path': tool_path, 'mtime': path.getmtime(tool_path)}
+    return tool_path
+
+
+def is_interactive(settings_file: str, overrides: dict) -> bool:
+    '''Checks if program runs in interactive mode, based on overrides or interactive option in settings file. Raises configparser.Error for incorrect value'''
+
+    if 'interactive' in overrides:
+        return overrides['interactive']
+    config = configparser.ConfigParser()
+    config.read(settings_file)
+    try:
+        return parse_setting('interactive', config.get('EXPORT_OPTIONS', 'interactive', fallback='True'))
+    except ValueError as e:
+        raise configparser.Error(f'{e} (section EXPORT_OPTIONS)')
+
+
+def initial_setup(settings_file: str = SETTINGS_FILE, overrides: dict | None = None) -> Settings:
+    '''Initial setup of program. Checks and creates settings.ini file with default values and validates if wkhtmltopdf and pandoc are installed. Results of checks are cached between runs. Returns settings object with applied overrides.
+
+    In non interactive mode settings file is never created/updated - missing settings get default values'''
+
+    overrides = overrides or {}
+    try:
+        interactive = is_interactive(settings_file, overrides)
+        settings = load_settings(settings_file, update_file=interactive)
+    except configparser.Error as e:
+        print(f'Incorrect settings in {settings_file}: {e}')
+        sys.exit(EXIT_ERROR)
     except ValueError as e:
-        print(f'{SETTINGS_FILE} was created/updated with default values. \nPlease rerun program after updating manually values in {SETTINGS_FILE} \n {e}')
+        print(f'{settings_file} was created/updated with default values. \nPlease rerun program after updating manually values in {settings_file} \n {e}')
         sys.exit(0)
 
+    for name, value in overrides.items():
+        setattr(settings, name, value)
+
+    # Options are validated before slower checks of wkhtmltopdf and pandoc
     try:
-        validate_wkhtmltopdf_exists()
-    except OSError:
-        print('\nProgram wkhtmltopdf was not found in system. Export to pdf will not be possibble. Settings were changed: save_to_pdf = False\n')
-        settings.save_to_pdf = False
+        validate_shard(settings.shard_index, settings.shard_count)
+    except ValueError as e:
+        print(f'{e}. Check SHARDING section in {settings_file}')
+        sys.exit(EXIT_ERROR)
+    try:
+        validate_image_workers(settings.image_workers)
+    except ValueError as e:
+        print(f'{e}. Check EXPORT_OPTIONS section in {settings_file}')
+        sys.exit(EXIT_ERROR)
+
+    cache = load_toolchain_cache()
+
+    # wkhtmltopdf is checked only if pdf will be generated. Path provided in settings is only checked to exist (no subprocess needed)
+    if settings.save_to_pdf and settings.wkhtmltopdf_path:
+        try:
+            validate_wkhtmltopdf_exists(settings.wkhtmltopdf_path)
+        except OSError as e:
+            print(f'{e}. Check wkhtmltopdf_path in {settings_file}')
+            sys.exit(EXIT_ERROR)
+    elif settings.save_to_pdf:
+        try:
+            settings.wkhtmltopdf_path = probe_toolchain(
+                'wkhtmltopdf', validate_wkhtmltopdf_exists, cache)
+        except OSError:
+            print('\nProgram wkhtmltopdf was not found in system. Export to pdf will not be possibble. Settings were changed: save_to_pdf = False\n')
+            settings.save_to_pdf = False
 
     try:
-        validate_pandoc_exists()
+        pandoc_path = probe_toolchain('pandoc', validate_pandoc_exists, cache)
     except OSError:
         print('\nProgram pandoc was not found in system. It is required for program to properly work\n')
-        sys.exit(0)
+        sys.exit(EXIT_ERROR)
+
+    # pypandoc checks only provided path instead of trying all known pandoc locations
+    os.environ.setdefault('PYPANDOC_PANDOC', pandoc_path)
+    save_toolchain_cache(cache)
 
     return settings
 
 
-def validate_jira(settings: Settings) -> JIRA:
+def validate_jira(settings: Settings, settings_file: str = SETTINGS_FILE) -> JIRA:
     '''Validates export path and authenticates to JIRA. Returns JIRA object'''
 
+    import_jira()
     try:
         validate_export_path(settings.export_path)
     except FileExistsError:
         print('There is File with the same Name as Directory specified in settings. Remove the file or change settings.')
-        sys.exit(1)
+        sys.exit(EXIT_ERROR)
 
     try:
         jira = authenticate_jira(
@@ -322,85 +997,252 @@ def validate_jira(settings: Settings) -> JIRA:
 
     except IndexError:
         print("Incorrect url adress format")
-        sys.exit(1)
+        sys.exit(EXIT_ERROR)
     except socket.gaierror as error:
         print(
-            f"Cannot connect to url. Check if url is correct in {SETTINGS_FILE}")
-        sys.exit(1)
+            f"Cannot connect to url. Check if url is correct in {settings_file}")
+        sys.exit(EXIT_ERROR)
     except JIRAError as error:
         print(
             f"Failed to connect to Jira server: \nURL:{error.url}\n{error.response}\n{error.text}")
-        sys.exit(1)
+        sys.exit(EXIT_ERROR)
 
     return jira
 
 
-def export_issues(settings: Settings, jira: JIRA) -> None:
-    '''Export issues from JIRA to HTML/PDF files based on settings.ini'''
+def print_progress(event: dict, message: str) -> None:
+    '''Default progress reporter. Prints human readable message'''
+
+    print(message)
+
+
+def progress_reporter(progress_format: str, stream: TextIO) -> Callable[[dict, str], None]:
+    '''Returns function reporting progress to stream - human readable message for text format or event as json line for json format'''
+
+    def report(event: dict, message: str) -> None:
+        if progress_format == 'json':
+            print(json.dumps(event), file=stream, flush=True)
+        else:
+            print(message, file=stream)
+    return report
+
+
+def prepare_issue(issue: resources.Issue, settings: Settings, image_pool: Executor | None = None) -> tuple[list[str], dict[str, Future]]:
+    '''Downloads attachments of issue and submits downscaling of its images to image_pool (if provided) without waiting for it. Returns list of attachments and dict of image derivative futures'''
+
+    attachments = download_attachments(
+        issue, settings.export_path, settings.skip_unchanged)
+    derivative_futures = {}
+    if settings.save_to_pdf and image_pool:
+        derivative_futures = submit_image_derivatives(
+            attachments, settings.export_path, image_pool)
+    return attachments, derivative_futures
+
+
+def export_issue(issue: resources.Issue, settings: Settings, jira: JIRA, image_pool: Executor | None = None, stats: ExportStats | None = None, prepared: tuple[list[str], dict[str, Future]] | None = None) -> list[str]:
+    '''Exports single issue with its attachments to HTML/PDF files based on settings. If image_pool is provided pdf uses downscaled images. Written and skipped files are counted in stats. Returns list of exported files
+
+    If issue was already prepared (see prepare_issue) its attachments are not downloaded again'''
+
+    attachments, derivative_futures = prepared or prepare_issue(
+        issue, settings, image_pool)
+    derivatives = None
+    if derivative_futures:
+        derivatives = collect_image_derivatives(derivative_futures)
+    files = list(attachments)
+    if settings.save_to_html:
+        files.append(f'{issue}.html')
+    if settings.save_to_pdf:
+        files.append(f'{issue}.pdf')
+
+    if settings.stream_issues:
+        export_issue_streamed(issue, attachments, settings,
+                              jira, derivatives, stats)
+        return files
+
+    # Generate formatted html str
+    html_content = populate_html(issue, attachments, jira)
+
+    # Save based on options values - formatting differently with convert_relative_to_absolute due to html working best with relative links and pdf with absolute ones (still need in both cases to modify images to have [Issue - filename] name)
+
+    if settings.save_to_html:
+
+        html_content_html = convert_relative_to_absolute(
+            html_content, settings.export_path, issue, True)
+        count_output(stats, save_to_html(html_content_html, issue,
+                                         settings.export_path, settings.skip_unchanged))
+    if settings.save_to_pdf:
+
+        html_content_pdf = convert_relative_to_absolute(
+            html_content, settings.export_path, issue, False, derivatives)
+        count_output(stats, generate_pdf_from_html_string(
+            html_content_pdf, issue, settings.export_path, settings.wkhtmltopdf_path, settings.skip_unchanged))
+    return files
+
+
+def export_issues(settings: Settings, jira: JIRA, report: Callable[[dict, str], None] = print_progress) -> ExportStats:
+    '''Export issues from JIRA to HTML/PDF files based on settings.ini. Only issues belonging to configured shard are exported and recorded in shard manifest. Failed issues are reported and skipped. Returns ExportStats'''
 
     # Initialize startAt and maxResults
     startAt = 0
     maxResults = 50
 
-    while True:
+    import_jira()
+    stats = ExportStats()
+    manifest_path = path.join(settings.export_path, manifest_filename(
+        settings.shard_index, settings.shard_count))
+
+    with ExitStack() as stack:
+
+        # Images for pdf are downscaled on process pool (only if Pillow is installed)
+        image_pool = None
+        if settings.save_to_pdf and settings.downscale_images and import_pillow():
+            image_pool = stack.enter_context(ProcessPoolExecutor(
+                max_workers=settings.image_workers or None))
+
+        # Manifest written line by line, so interrupted shard still leaves record of exported issues and manifest is never kept in memory
+        manifest_stream = stack.enter_context(
+            open(manifest_path, 'w', encoding='utf-8'))
+        manifest_stream.write(json.dumps({'jira_project': settings.jira_project,
+                                          'shard_index': settings.shard_index,
+                                          'shard_count': settings.shard_count}) + '\n')
+        manifest_stream.flush()
+
+        while True:
+
+            # Get the issues using the Jira module's search method. With sharding only ids are requested first and full issues only for this shard
+            sharded = settings.shard_count > 1
+            try:
+                result_list = find_issues(
+                    settings.jira_project, jira, startAt, maxResults, 'id' if sharded else ISSUE_FIELDS)
+                # config.get( 'ISSUE_FILTER', 'jira_project')
+
+                # Break the loop if no more issues are returned
+                if not result_list:
+                    break
+
+                if sharded:
+                    result_list = find_shard_issues(
+                        result_list, jira, settings.shard_index, settings.shard_count)
+            except JIRAError as error:
+                print(
+                    f"Failed to find provided project name: {settings.jira_project}\n{error.response}\n{error.text}")
+                sys.exit(EXIT_ERROR)
+
+            # With image pool attachments of whole page are downloaded first, so images of all issues are downscaled on the pool while attachments of next issues are downloaded and previous issues are rendered
+            prepared = {}
+            if image_pool:
+                for issue in result_list:
+                    try:
+                        prepared[str(issue)] = prepare_issue(
+                            issue, settings, image_pool)
+                    except (JIRAError, OSError, RuntimeError) as error:
+                        prepared[str(issue)] = error
+
+            # Iterate through the results. Issues are removed from result list while processed, so memory of exported issue is released before next one
+            for issue in consume_issues(result_list):
 
-        # Get the issues using the Jira module's search method
-        try:
-            result_list = find_issues(
-                settings.jira_project, jira, startAt, maxResults)
-            # config.get( 'ISSUE_FILTER', 'jira_project')
-        except JIRAError as error:
-            print(
-                f"Failed to find provided project name: {settings.jira_project}\n{error.response}\n{error.text}")
-            sys.exit(1)
-
-        # Break the loop if no more issues are returned
-        if not result_list:
-            break
+                try:
+                    issue_prepared = prepared.pop(str(issue), None)
+                    if isinstance(issue_prepared, Exception):
+                        raise issue_prepared
+                    files = export_issue(
+                        issue, settings, jira, image_pool, stats, issue_prepared)
+                except (JIRAError, OSError, RuntimeError) as error:
+                    stats.failed += 1
+                    report({'event': 'issue', 'issue': str(issue), 'status': 'failed', 'error': str(error)},
+                           f"Export of {issue} failed: {error}")
+                    continue
+
+                stats.exported += 1
+                messages = []
+                if settings.save_to_html:
+                    messages.append(f"HTML generated for {issue}")
+                if settings.save_to_pdf:
+                    messages.append(f"PDF generated for {issue}")
+                report({'event': 'issue', 'issue': str(issue), 'status': 'exported', 'files': files},
+                       '\n'.join(messages))
+
+                manifest_stream.write(json.dumps(
+                    {'key': str(issue), 'id': issue.id, 'files': files}) + '\n')
+                manifest_stream.flush()
+
+            # Update the startAt for the next iteration
+            startAt += maxResults
+
+        manifest_stream.write(json.dumps({'finished': True}) + '\n')
+
+    return stats
+
+
+def merge_manifests_command(source_paths: list[str], overrides: dict) -> None:
+    '''Standalone merge step run after all shards finished. Merges shard manifests from source_paths into MANIFEST_FILE in first of them and exits with EXIT_ERROR if manifest is not complete'''
+
+    report = progress_reporter(overrides.get('progress_format', Settings.progress_format), sys.stdout)
+    try:
+        shard_count = overrides.get('shard_count') or find_manifests_shard_count(source_paths)
+    except ValueError as e:
+        print(e, file=sys.stderr)
+        sys.exit(EXIT_ERROR)
 
-        # Iterate through the results
-        for issue in result_list:
+    manifest = merge_manifests(source_paths[0], shard_count, source_paths)
+    report({'event': 'merge', 'manifest': path.join(source_paths[0], MANIFEST_FILE), 'shard_count': shard_count,
+            'shards': manifest['shards'], 'issues': len(manifest['issues']), 'complete': manifest['complete']},
+           f"Merged manifests of shards {manifest['shards']} of {shard_count} ({len(manifest['issues'])} issues) into {path.join(source_paths[0], MANIFEST_FILE)}")
+    if not manifest['complete']:
+        print(f"{MANIFEST_FILE} is not complete - not all shards finished", file=sys.stderr)
+        sys.exit(EXIT_ERROR)
+    sys.exit(EXIT_OK)
 
-            # Generate formatted html str
-            html_content = populate_html(issue, settings.export_path, jira)
 
-            # Save based on options values - formatting differently with convert_relative_to_absolute due to html working best with relative links and pdf with absolute ones (still need in both cases to modify images to have [Issue - filename] name)
+def main(argv: list[str] | None = None) -> None:
+    '''Command line entry point. Exits with EXIT_PARTIAL if some issues failed to export'''
 
-            if settings.save_to_html:
+    args = parse_args(argv)
+    try:
+        overrides = settings_overrides(args, os.environ)
+    except ValueError as e:
+        print(e, file=sys.stderr)
+        sys.exit(EXIT_ERROR)
 
-                html_content_html = convert_relative_to_absolute(
-                    html_content, settings.export_path, issue, True)
-                save_to_html(html_content_html, issue, settings.export_path)
-                print(f"HTML generated for {issue}")
-            if settings.save_to_pdf:
+    if args.merge_manifests:
+        merge_manifests_command(args.merge_manifests, overrides)
 
-                html_content_pdf = convert_relative_to_absolute(
-                    html_content, settings.export_path, issue, False)
-                generate_pdf_from_html_string(
-                    html_content_pdf, issue, settings.export_path)
-                print(f"PDF generated for {issue}")
+    # Progress format is known only after settings are loaded, so setup messages always go to stderr. With json progress only progress events are written to stdout
+    stdout = sys.stdout
+    with redirect_stdout(sys.stderr):
+        settings = initial_setup(args.settings, overrides)
+    report = progress_reporter(settings.progress_format, stdout)
 
-        # Update the startAt for the next iteration
-        startAt += maxResults
+    with redirect_stdout(sys.stderr) if settings.progress_format == 'json' else nullcontext():
 
+        if settings.interactive:
+            choice = input(
+                f'Program will begin to export issues from JIRA based on values provided in {args.settings}. Continue? [y/n] :')
 
-def main():
+            if not choice.lower() == 'y':
+                print('Aborted')
+                sys.exit(0)
 
-    settings = initial_setup()
+        jira = validate_jira(settings, args.settings)
 
-    choice = input(
-        f'Program will begin to export issues from JIRA based on values provided in {SETTINGS_FILE}. Continue? [y/n] :')
+        stats = export_issues(settings, jira, report)
 
-    if not choice.lower() == 'y':
-        print('Aborted')
-        sys.exit(0)
+        manifest = merge_manifests(settings.export_path, settings.shard_count)
+        if not manifest['complete']:
+            print(f"Shards finished so far: {manifest['shards']} of {settings.shard_count}. Run jira_export --merge-manifests {settings.export_path} after all shards finish to complete {MANIFEST_FILE}")
 
-    jira = validate_jira(settings)
+    report({'event': 'summary', 'exported': stats.exported, 'failed': stats.failed,
+            'written': stats.written, 'skipped': stats.skipped, 'manifest_complete': manifest['complete']},
+           f'Exported issues: {stats.exported}, failed: {stats.failed}. Files written: {stats.written}, skipped (unchanged): {stats.skipped}')
 
-    export_issues(settings, jira)
+    if settings.interactive:
+        print("Press any key to exit...")
+        import_keyboard()
+        keyboard.read_event(suppress=True)
 
-    print("Press any key to exit...")
-    keyboard.read_event(suppress=True)
+    if stats.failed:
+        sys.exit(EXIT_PARTIAL)
 
 
 if __name__ == '__main__':
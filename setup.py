@@ -32,9 +32,12 @@ setup(
         'pypandoc-binary',
         'keyboard'
     ],
+    extras_require={
+        'images': ['Pillow'],
+    },
     entry_points={
         'console_scripts': [
-            'jira_export=jira_export:main',
+            'jira_export=jira_export.jira_export:main',
         ],
     },
 )
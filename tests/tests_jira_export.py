@@ -1,5 +1,9 @@
+import json
 import os
-from unittest.mock import MagicMock, Mock, patch
+import subprocess
+import sys
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from unittest.mock import ANY, MagicMock, Mock, patch
 
 import pytest
 from context import j
@@ -191,13 +195,19 @@ def test_populate_html_attachments_is_list_appended():
 
 
 class MockAttachment:
-    def __init__(self, filename, content):
+    def __init__(self, filename, content, id='10000'):
         self.filename = filename
         self.content = content
+        self.id = id
+        self.size = len(content)
 
     def get(self):
         return self.content
 
+    def iter_content(self, chunk_size=1024):
+        for start in range(0, len(self.content), chunk_size):
+            yield self.content[start:start + chunk_size]
+
 
 class MockIssue:
     def __init__(self, attachments=None):
@@ -243,6 +253,25 @@ def test_download_attachments_validate_files_and_contents_goodfiles(tmpdir, mock
                 assert file.read() == attachment.content
 
 
+def test_download_attachments_skip_unchanged(tmpdir):
+    attachment = MockAttachment('file1.txt', b'content1')
+    with tmpdir.as_cwd():
+        with patch.object(attachment, 'iter_content', wraps=attachment.iter_content) as mock_iter_content:
+            j.download_attachments(MockIssue(attachments=[attachment]), '', True)
+            j.download_attachments(MockIssue(attachments=[attachment]), '', True)
+            assert mock_iter_content.call_count == 1
+
+            # New upload with the same filename has new id
+            attachment.id = '10001'
+            j.download_attachments(MockIssue(attachments=[attachment]), '', True)
+            assert mock_iter_content.call_count == 2
+
+            # Written without skip_unchanged - stale hash removed, so file is downloaded again
+            j.download_attachments(MockIssue(attachments=[attachment]), '', False)
+            j.download_attachments(MockIssue(attachments=[attachment]), '', True)
+            assert mock_iter_content.call_count == 4
+
+
 def test_download_attachments_validate_files_and_contents_bad_files(tmpdir, mock_jira_issue_bad_files):
     path_exp = 'EXP/'
     with tmpdir.as_cwd():
@@ -286,7 +315,7 @@ def test_find_issues_is_called(jira_mock):
     jira_mock.search_issues.return_value = result_list_mock
     result = j.find_issues(jira_project_key, jira_mock, start_at, max_results)
     jira_mock.search_issues.assert_called_once_with(
-        f'project={jira_project_key}', startAt=start_at, maxResults=max_results
+        f'project={jira_project_key} ORDER BY id', startAt=start_at, maxResults=max_results, fields=j.ISSUE_FIELDS
     )
     assert isinstance(result, j.client.ResultList)
 
@@ -309,15 +338,591 @@ def test_populate_html_fields_description_empty():
     assert result == expected
 
 
-def test_populate_html_comments():  # rewrite later to include test to multiple comments - problem with MOck - Jira setup
+def test_populate_html_comments():
     jira_issue_mock = MockIssue()
     jira_mock = Mock(spec=j.JIRA)
-    jira_mock.comment().created = '1'
-    jira_mock.comment().author.displayName = 'John'
-    jira_issue_mock.fields.comment.comments = ['comment1']
+    jira_mock._get_json.return_value = {'startAt': 0, 'maxResults': 50, 'total': 1, 'comments': [
+        {'created': '1', 'author': {'displayName': 'John'}, 'body': 'Comment Body'}]}
     convert_jira_wiki_markup_mock = Mock()
     convert_jira_wiki_markup_mock.return_value = "Formatted Comment Body"
     expected = "<h3>COMMENTS:</h3>1 <br> John <br>Formatted Comment Body <br>"
     with patch('jira_export.jira_export.convert_jira_wiki_markup', convert_jira_wiki_markup_mock):
         result = j.populate_html_comments('', jira_issue_mock, jira_mock)
         assert result == expected
+    jira_mock._get_json.assert_called_once_with('issue/ISSUE1/comment', params={'startAt': 0, 'maxResults': j.COMMENTS_PAGE_SIZE})
+
+
+def test_iter_html_comments_paged():
+    total = j.COMMENTS_PAGE_SIZE * 2 + 1
+    comments = [{'created': str(i), 'author': {'displayName': 'John'}, 'body': f'body {i}'} for i in range(total)]
+
+    def get_json(path, params):
+        start_at = params['startAt']
+        return {'startAt': start_at, 'total': total,
+                'comments': comments[start_at:start_at + params['maxResults']]}
+
+    jira_mock = Mock(spec=j.JIRA)
+    jira_mock._get_json.side_effect = get_json
+    with patch('jira_export.jira_export.convert_jira_wiki_markup', side_effect=lambda body: body):
+        html_parts = list(j.iter_html_comments(MockIssue(), jira_mock))
+    assert len(html_parts) == total + 1
+    assert html_parts[-1] == f'{total - 1} <br> John <br>body {total - 1} <br>'
+    assert jira_mock._get_json.call_count == 3
+
+
+class MockShardIssue:
+    def __init__(self, issue_id):
+        self.id = str(issue_id)
+        self.fields = MagicMock()
+        self.fields.attachment = []
+
+    def __str__(self):
+        return f'TEST-{self.id}'
+
+
+class MockSearchJira:
+    def __init__(self, issues):
+        self.issues = issues
+        self.searches = []
+
+    def search_issues(self, jql, startAt, maxResults, fields):
+        self.searches.append((jql, fields))
+        if jql.startswith('id in ('):
+            issue_ids = jql[len('id in ('):jql.index(')')].split(',')
+            return [issue for issue in self.issues if issue.id in issue_ids]
+        return self.issues[startAt:startAt + maxResults]
+
+
+@pytest.mark.parametrize('shard_index,shard_count', [(-1, 2), (2, 2), (0, 0)])
+def test_validate_shard_incorrect_options(shard_index, shard_count):
+    with pytest.raises(ValueError):
+        j.validate_shard(shard_index, shard_count)
+
+
+def test_validate_image_workers():
+    j.validate_image_workers(0)
+    j.validate_image_workers(4)
+    with pytest.raises(ValueError):
+        j.validate_image_workers(-1)
+
+
+def test_is_issue_in_shard_every_issue_in_exactly_one_shard():
+    shard_count = 3
+    for issue_id in range(10000, 10100):
+        shards = [shard_index for shard_index in range(shard_count)
+                  if j.is_issue_in_shard(str(issue_id), shard_index, shard_count)]
+        assert len(shards) == 1
+
+
+def test_export_issues_shards_are_disjoint_and_merged(tmpdir):
+    shard_count = 3
+    issues = [MockShardIssue(issue_id) for issue_id in range(10000, 10120)]
+    with tmpdir.as_cwd():
+        os.mkdir('EXP')
+        with patch('jira_export.jira_export.populate_html', return_value='<p>x</p>'):
+            for shard_index in range(shard_count):
+                jira = MockSearchJira(issues)
+                j.export_issues(j.Settings(export_path='EXP', save_to_pdf=False, shard_index=shard_index,
+                                shard_count=shard_count), jira)
+                # Full issues are requested only for issues of this shard
+                assert all(fields == 'id' for jql, fields in jira.searches if jql.startswith('project='))
+                assert all(fields == j.ISSUE_FIELDS for jql, fields in jira.searches if jql.startswith('id in'))
+        manifests = [j.load_manifest(os.path.join('EXP', j.manifest_filename(shard_index, shard_count)))
+                     for shard_index in range(shard_count)]
+        merged = j.merge_manifests('EXP', shard_count)
+
+        exported = [key for manifest in manifests for key in manifest['issues']]
+        assert len(exported) == len(set(exported)) == len(issues)
+        assert merged['complete']
+        assert sorted(merged['issues']) == sorted(str(issue) for issue in issues)
+        assert merged['issues']['TEST-10000']['files'] == ['TEST-10000.html']
+        assert os.path.isfile(os.path.join('EXP', j.MANIFEST_FILE))
+
+
+def test_merge_manifests_incomplete_ignores_other_shard_count(tmpdir):
+    with tmpdir.as_cwd():
+        with open(j.manifest_filename(1, 2), 'w') as save_stream:
+            save_stream.write('{"jira_project": "TEST", "shard_index": 1, "shard_count": 2}\n'
+                              '{"key": "TEST-1", "id": "1", "files": []}\n'
+                              '{"key": "TEST-3", "id"')
+        with open(j.manifest_filename(0, 3), 'w') as save_stream:
+            save_stream.write('{"jira_project": "TEST", "shard_index": 0, "shard_count": 3}\n'
+                              '{"key": "TEST-3", "id": "3", "files": []}\n'
+                              '{"finished": true}\n')
+        open(j.manifest_filename(0, 2), 'w').close()
+        merged = j.merge_manifests('', 2)
+        assert merged['shards'] == []
+        assert not merged['complete']
+        assert list(merged['issues']) == ['TEST-1']
+
+
+def test_main_merge_manifests_from_separate_folders(tmpdir, capsys):
+    with tmpdir.as_cwd():
+        for shard_index, folder in enumerate(['HOST_A', 'HOST_B']):
+            os.mkdir(folder)
+            with open(os.path.join(folder, j.manifest_filename(shard_index, 2)), 'w') as save_stream:
+                save_stream.write(json.dumps({'jira_project': 'TEST', 'shard_index': shard_index, 'shard_count': 2}) + '\n' +
+                                  json.dumps({'key': f'TEST-{shard_index}', 'id': str(shard_index), 'files': []}) + '\n' +
+                                  '{"finished": true}\n')
+        with pytest.raises(SystemExit) as exc_info:
+            j.main(['--merge-manifests', 'HOST_A', 'HOST_B', '--progress-format', 'json'])
+        assert exc_info.value.code == j.EXIT_OK
+        with open(os.path.join('HOST_A', j.MANIFEST_FILE), encoding='utf-8') as load_stream:
+            merged = json.load(load_stream)
+        assert merged['complete']
+        assert sorted(merged['issues']) == ['TEST-0', 'TEST-1']
+        assert not os.path.exists(j.SETTINGS_FILE)
+    event = json.loads(capsys.readouterr().out)
+    assert event['event'] == 'merge' and event['complete'] and event['issues'] == 2
+
+    # Merge of unfinished shards fails, so scheduler can run it again
+    with tmpdir.as_cwd():
+        with pytest.raises(SystemExit) as exc_info:
+            j.main(['--merge-manifests', 'HOST_A'])
+        assert exc_info.value.code == j.EXIT_ERROR
+        with pytest.raises(SystemExit) as exc_info:
+            j.main(['--merge-manifests', 'EMPTY'])
+        assert exc_info.value.code == j.EXIT_ERROR
+
+
+def test_merge_manifests_unchanged_not_replaced(tmpdir):
+    with tmpdir.as_cwd():
+        with open(j.manifest_filename(0, 1), 'w') as save_stream:
+            save_stream.write('{"jira_project": "TEST", "shard_index": 0, "shard_count": 1}\n'
+                              '{"finished": true}\n')
+        j.merge_manifests('', 1)
+        with patch('jira_export.jira_export.os.replace') as mock_replace:
+            assert j.merge_manifests('', 1)['complete']
+        mock_replace.assert_not_called()
+
+
+def test_consume_issues_releases_issues_in_order():
+    result_list = ['ISSUE-1', 'ISSUE-2', 'ISSUE-3']
+    consumed = []
+    for issue in j.consume_issues(result_list):
+        consumed.append(issue)
+        assert len(result_list) == 3 - len(consumed)
+    assert consumed == ['ISSUE-1', 'ISSUE-2', 'ISSUE-3']
+
+
+def test_export_issue_streamed_same_as_not_streamed(tmpdir):
+    issue = MockIssue()
+    html_parts = ['<h1>ISSUE1</h1>', '<p><img src="image.png" /></p>', '<a href="ISSUE1-a.txt">ISSUE1-a.txt</a><br>']
+    settings = j.Settings(export_path='EXP', save_to_pdf=True, stream_issues=True)
+    with tmpdir.as_cwd():
+        os.mkdir('EXP')
+        with patch('jira_export.jira_export.iter_html', return_value=iter(html_parts)), \
+                patch('jira_export.jira_export.generate_pdf_from_html_file') as mock_generate_pdf:
+            j.export_issue_streamed(issue, [], settings, None)
+            pdf_source_path = os.path.join('EXP', 'ISSUE1-PDF_SOURCE.html')
+            mock_generate_pdf.assert_called_once_with(pdf_source_path, issue, 'EXP', '', ANY)
+        with open(os.path.join('EXP', 'ISSUE1.html'), encoding='utf-8') as load_stream:
+            assert load_stream.read() == j.convert_relative_to_absolute(''.join(html_parts), 'EXP', issue, True)
+        assert not os.path.exists(pdf_source_path)
+
+
+def test_import_does_not_load_backends():
+    code = ('import sys; import jira_export.jira_export; '
+            'print(any(m in sys.modules for m in ("jira", "pypandoc", "pdfkit", "keyboard")))')
+    result = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True,
+                            cwd=os.path.join(os.path.dirname(__file__), '..'))
+    assert result.stdout.strip() == 'False'
+
+
+def test_probe_toolchain_cached_until_binary_modified(tmpdir):
+    tool_path = str(tmpdir.join('tool'))
+    with open(tool_path, 'w') as save_stream:
+        save_stream.write('v1')
+    validate = Mock(return_value=tool_path)
+    cache = {}
+
+    assert j.probe_toolchain('tool', validate, cache) == tool_path
+    assert j.probe_toolchain('tool', validate, cache) == tool_path
+    assert validate.call_count == 1
+
+    os.utime(tool_path, (0, 0))
+    j.probe_toolchain('tool', validate, cache)
+    assert validate.call_count == 2
+
+
+def test_toolchain_cache_saved_and_loaded(tmpdir, monkeypatch):
+    monkeypatch.setenv('XDG_CACHE_HOME', str(tmpdir))
+    assert j.load_toolchain_cache() == {}
+    j.save_toolchain_cache({'pandoc': {'path': '/usr/bin/pandoc', 'mtime': 1.0}})
+    assert j.load_toolchain_cache() == {'pandoc': {'path': '/usr/bin/pandoc', 'mtime': 1.0}}
+
+
+def test_main_non_interactive_does_not_wait_for_user():
+    settings = j.Settings(interactive=False)
+    with patch('jira_export.jira_export.initial_setup', return_value=settings), \
+            patch('jira_export.jira_export.validate_jira'), \
+            patch('jira_export.jira_export.export_issues', return_value=j.ExportStats(exported=1)) as mock_export_issues, \
+            patch('jira_export.jira_export.merge_manifests', return_value={'complete': True}), \
+            patch('jira_export.jira_export.import_keyboard') as mock_import_keyboard, \
+            patch('builtins.input') as mock_input:
+        j.main([])
+    mock_input.assert_not_called()
+    mock_import_keyboard.assert_not_called()
+    mock_export_issues.assert_called_once()
+
+
+def test_settings_overrides_command_line_before_environment():
+    args = j.parse_args(['--jira-project', 'CLI', '--no-save-to-pdf', '--shard-count', '4'])
+    environ = {'JIRA_EXPORT_JIRA_PROJECT': 'ENV', 'JIRA_EXPORT_SHARD_INDEX': '3',
+               'JIRA_EXPORT_INTERACTIVE': 'false', 'JIRA_EXPORT_PROGRESS_FORMAT': 'json'}
+    overrides = j.settings_overrides(args, environ)
+    assert overrides == {'jira_project': 'CLI', 'save_to_pdf': False, 'shard_count': 4, 'shard_index': 3,
+                         'interactive': False, 'progress_format': 'json'}
+
+
+@pytest.mark.parametrize('argv', [['--bogus'], ['--shard-count', 'four'], ['--progress-format', 'xml']])
+def test_main_usage_error_is_not_partial_export(argv, capsys):
+    with pytest.raises(SystemExit) as exc_info:
+        j.main(argv)
+    assert exc_info.value.code == j.EXIT_ERROR
+    assert capsys.readouterr().out == ''
+
+
+def test_main_incorrect_environment_override_to_stderr(monkeypatch, capsys):
+    monkeypatch.setenv('JIRA_EXPORT_SHARD_INDEX', 'abc')
+    with pytest.raises(SystemExit) as exc_info:
+        j.main([])
+    assert exc_info.value.code == j.EXIT_ERROR
+    captured = capsys.readouterr()
+    assert captured.out == ''
+    assert 'Incorrect value of shard_index: abc' in captured.err
+
+
+@pytest.mark.parametrize('name,value', [('save_to_pdf', 'maybe'), ('shard_index', 'one'), ('progress_format', 'xml')])
+def test_parse_setting_incorrect_value(name, value):
+    with pytest.raises(ValueError):
+        j.parse_setting(name, value)
+
+
+def test_load_settings_without_update_file_does_not_write_settings(tmpdir):
+    with tmpdir.as_cwd():
+        settings = j.load_settings('other.ini', update_file=False)
+        assert settings == j.Settings()
+        assert not os.path.exists('other.ini')
+        assert not os.path.exists(j.SETTINGS_FILE)
+
+
+def test_export_issues_failed_issue_reported_and_skipped(tmpdir):
+    issues = [MockShardIssue(issue_id) for issue_id in range(1, 4)]
+    report = Mock()
+
+    def export_issue(issue, settings, jira, image_pool=None, stats=None, prepared=None):
+        if issue.id == '2':
+            raise OSError('disk full')
+        return [f'{issue}.html']
+
+    with tmpdir.as_cwd():
+        with patch('jira_export.jira_export.export_issue', side_effect=export_issue):
+            stats = j.export_issues(j.Settings(export_path='', save_to_pdf=False), MockSearchJira(issues), report)
+        manifest = j.load_manifest(j.manifest_filename(0, 1))
+
+    assert stats == j.ExportStats(exported=2, failed=1)
+    assert report.call_args_list[1].args[0] == {'event': 'issue', 'issue': 'TEST-2', 'status': 'failed', 'error': 'disk full'}
+    assert sorted(manifest['issues']) == ['TEST-1', 'TEST-3']
+    assert manifest['finished']
+
+
+def test_main_partial_failure_exit_code_and_json_progress(capsys):
+    with patch('jira_export.jira_export.initial_setup', side_effect=lambda settings_file, overrides: j.Settings(**overrides)), \
+            patch('jira_export.jira_export.validate_jira'), \
+            patch('jira_export.jira_export.export_issues', return_value=j.ExportStats(exported=3, failed=1)), \
+            patch('jira_export.jira_export.merge_manifests', return_value={'complete': True}):
+        with pytest.raises(SystemExit) as exc_info:
+            j.main(['--no-interactive', '--progress-format', 'json'])
+
+    assert exc_info.value.code == j.EXIT_PARTIAL
+    assert capsys.readouterr().out.splitlines() == [
+        '{"event": "summary", "exported": 3, "failed": 1, "written": 0, "skipped": 0, "manifest_complete": true}']
+
+
+def save_test_image(file_path, size, mode='RGB'):
+    Image = pytest.importorskip('PIL.Image')
+    Image.new(mode, size, 'red').save(file_path)
+
+
+def test_create_image_derivative_downscaled_and_cached(tmpdir):
+    Image = pytest.importorskip('PIL.Image')
+    source_path = str(tmpdir.join('ISSUE1-big.png'))
+    save_test_image(source_path, (3000, 1000))
+
+    derivative_path = j.create_image_derivative(source_path, str(tmpdir))
+    assert derivative_path.endswith('.jpg')
+    with Image.open(derivative_path) as image:
+        assert image.size == (j.IMAGE_WIDTH * j.IMAGE_DERIVATIVE_SCALE, 200)
+
+    with patch.object(Image, 'open') as mock_open:
+        assert j.create_image_derivative(source_path, str(tmpdir)) == derivative_path
+        mock_open.assert_not_called()
+
+
+def test_create_image_derivative_transparent_image_kept_png(tmpdir):
+    source_path = str(tmpdir.join('ISSUE1-big.png'))
+    save_test_image(source_path, (3000, 1000), 'RGBA')
+    assert j.create_image_derivative(source_path, str(tmpdir)).endswith('.png')
+
+
+@pytest.mark.parametrize('filename,content', [('ISSUE1-small.png', None), ('ISSUE1-broken.png', b'not image'), ('ISSUE1-missing.png', False)])
+def test_create_image_derivative_not_needed(tmpdir, filename, content):
+    source_path = str(tmpdir.join(filename))
+    if content is None:
+        save_test_image(source_path, (100, 100))
+    elif content:
+        tmpdir.join(filename).write_binary(content)
+    assert j.create_image_derivative(source_path, str(tmpdir)) is None
+
+
+def test_create_image_derivatives_on_process_pool(tmpdir):
+    save_test_image(str(tmpdir.join('ISSUE1-a.png')), (3000, 1000))
+    save_test_image(str(tmpdir.join('ISSUE1-b.jpg')), (100, 100))
+    tmpdir.join('ISSUE1-c.txt').write('text')
+    with ProcessPoolExecutor(max_workers=2) as pool:
+        derivatives = j.create_image_derivatives(
+            ['ISSUE1-a.png', 'ISSUE1-b.jpg', 'ISSUE1-c.txt'], str(tmpdir), pool)
+    assert list(derivatives) == ['ISSUE1-a.png']
+    assert os.path.dirname(derivatives['ISSUE1-a.png']) == str(tmpdir.join(j.IMAGE_DERIVATIVES_DIR))
+
+
+def test_export_issues_image_derivatives_submitted_for_whole_page(tmpdir):
+    issues = [MockShardIssue(issue_id) for issue_id in range(1, 4)]
+    events = []
+
+    def download_attachments(issue, path_exp, skip_unchanged=False):
+        if issue.id == '2':
+            raise OSError('disk full')
+        events.append(f'download {issue}')
+        return [f'{issue}-a.png']
+
+    def create_image_derivative(source_path, derivatives_dir):
+        return os.path.join(derivatives_dir, os.path.basename(source_path))
+
+    def generate_pdf(html_content, jira_issue_key, path_exp, wkhtmltopdf_path='', skip_unchanged=False):
+        events.append(f'render {jira_issue_key}')
+        assert os.path.join(j.IMAGE_DERIVATIVES_DIR, f'{jira_issue_key}-a.png') in html_content
+        return True
+
+    with tmpdir.as_cwd():
+        with patch('jira_export.jira_export.import_pillow', return_value=True), \
+                patch('jira_export.jira_export.ProcessPoolExecutor', ThreadPoolExecutor), \
+                patch('jira_export.jira_export.download_attachments', side_effect=download_attachments), \
+                patch('jira_export.jira_export.create_image_derivative', side_effect=create_image_derivative), \
+                patch('jira_export.jira_export.populate_html', side_effect=lambda issue, attachments, jira: '<img src="a.png">'), \
+                patch('jira_export.jira_export.generate_pdf_from_html_string', side_effect=generate_pdf):
+            stats = j.export_issues(j.Settings(export_path='', save_to_html=False), MockSearchJira(issues), Mock())
+
+    assert events == ['download TEST-1', 'download TEST-3', 'render TEST-1', 'render TEST-3']
+    assert stats == j.ExportStats(exported=2, failed=1, written=2)
+
+
+def test_convert_relative_to_absolute_uses_derivatives(tmpdir):
+    html_str = '<img src="a.png"><img src="b.png">'
+    with tmpdir.as_cwd():
+        html_processed = j.convert_relative_to_absolute(
+            html_str, 'EXP', 'ISSUE1', False, {'ISSUE1-a.png': os.path.join('EXP', 'IMAGE_CACHE', 'hash.jpg')})
+        assert f'<img src="{os.path.join(os.getcwd(), "EXP", "IMAGE_CACHE", "hash.jpg")}"' in html_processed
+        assert f'<img src="{os.path.join(os.getcwd(), "EXP", "ISSUE1-b.png")}"' in html_processed
+
+
+def test_save_to_html_skip_unchanged(tmpdir):
+    with tmpdir.as_cwd():
+        assert j.save_to_html('<p>1</p>', 'ISSUE1', '', True)
+        assert not j.save_to_html('<p>1</p>', 'ISSUE1', '', True)
+        assert j.save_to_html('<p>2</p>', 'ISSUE1', '', True)
+        with open('ISSUE1.html', encoding='utf-8') as load_stream:
+            assert load_stream.read() == '<p>2</p>'
+
+        os.remove('ISSUE1.html')
+        assert j.save_to_html('<p>2</p>', 'ISSUE1', '', True)
+
+
+def test_save_to_html_without_skip_unchanged_removes_stale_hash(tmpdir):
+    with tmpdir.as_cwd():
+        assert j.save_to_html('<p>A</p>', 'ISSUE1', '', True)
+        assert j.save_to_html('<p>B</p>', 'ISSUE1', '', False)
+        assert not os.path.exists(j.output_hash_path('ISSUE1.html'))
+        assert j.save_to_html('<p>A</p>', 'ISSUE1', '', True)
+        with open('ISSUE1.html', encoding='utf-8') as load_stream:
+            assert load_stream.read() == '<p>A</p>'
+
+
+def test_generate_pdf_from_html_string_skip_unchanged(tmpdir):
+    def from_string(html_content, file_path, options, configuration):
+        with open(file_path, 'w') as save_stream:
+            save_stream.write('PDF')
+
+    with tmpdir.as_cwd():
+        image_path = os.path.join(os.getcwd(), 'ISSUE1-a.png')
+        with open(image_path, 'wb') as save_stream:
+            save_stream.write(b'image1')
+        html_content = f'<img src="{image_path}" width="300" height="200">'
+
+        with patch('jira_export.jira_export.import_pdfkit'), \
+                patch('jira_export.jira_export.configuration', create=True), \
+                patch('jira_export.jira_export.from_string', side_effect=from_string, create=True) as mock_from_string:
+            assert j.generate_pdf_from_html_string(html_content, 'ISSUE1', '', skip_unchanged=True)
+            assert not j.generate_pdf_from_html_string(html_content, 'ISSUE1', '', skip_unchanged=True)
+            assert mock_from_string.call_count == 1
+
+            with open(image_path, 'wb') as save_stream:
+                save_stream.write(b'image2')
+            assert j.generate_pdf_from_html_string(html_content, 'ISSUE1', '', skip_unchanged=True)
+            assert mock_from_string.call_count == 2
+
+
+def test_export_issue_streamed_skip_unchanged_counted(tmpdir):
+    issue = MockIssue()
+    settings = j.Settings(export_path='EXP', save_to_pdf=False, stream_issues=True)
+    stats = j.ExportStats()
+    with tmpdir.as_cwd():
+        os.mkdir('EXP')
+        for html_parts in (['<h1>ISSUE1</h1>'], ['<h1>ISSUE1</h1>'], ['<h1>ISSUE1</h1>', '<p>new comment</p>']):
+            with patch('jira_export.jira_export.iter_html', return_value=iter(html_parts)):
+                j.export_issue_streamed(issue, [], settings, None, stats=stats)
+        with open(os.path.join('EXP', 'ISSUE1.html'), encoding='utf-8') as load_stream:
+            assert load_stream.read() == '<h1>ISSUE1</h1><p>new comment</p>'
+        assert sorted(os.listdir('EXP')) == sorted(['ISSUE1.html', j.OUTPUT_HASHES_DIR])
+    assert stats == j.ExportStats(written=2, skipped=1)
+
+
+def test_export_issue_streamed_without_skip_unchanged_removes_stale_hash(tmpdir):
+    issue = MockIssue()
+    settings = j.Settings(export_path='EXP', save_to_pdf=False, stream_issues=True)
+    with tmpdir.as_cwd():
+        os.mkdir('EXP')
+        for html_parts, skip_unchanged in ((['<p>A</p>'], True), (['<p>B</p>'], False), (['<p>A</p>'], True)):
+            settings.skip_unchanged = skip_unchanged
+            with patch('jira_export.jira_export.iter_html', return_value=iter(html_parts)):
+                j.export_issue_streamed(issue, [], settings, None)
+        with open(os.path.join('EXP', 'ISSUE1.html'), encoding='utf-8') as load_stream:
+            assert load_stream.read() == '<p>A</p>'
+
+
+@pytest.mark.parametrize('section,option,value', [('SHARDING', 'shard_index', 'abc'), ('EXPORT_OPTIONS', 'stream_issues', 'maybe'),
+                                                  ('EXPORT_OPTIONS', 'image_workers', 'many'), ('EXPORT_OPTIONS', 'image_workers', '-1'),
+                                                  ('EXPORT_OPTIONS', 'progress_format', 'xml')])
+def test_initial_setup_incorrect_optional_setting(tmpdir, capsys, section, option, value):
+    config = j.configparser.ConfigParser()
+    config.read_dict({'JIRA_ACCESS': {'jira_base_url': 'https://your_jira_instance/', 'jira_username': 'user', 'jira_api_token': 'token'},
+                      'EXPORT_OPTIONS': {'export_path': 'EXPORT', 'save_to_html': 'True', 'save_to_pdf': 'True'},
+                      'ISSUE_FILTER': {'jira_project': 'TEST'}})
+    if not config.has_section(section):
+        config.add_section(section)
+    config.set(section, option, value)
+    with tmpdir.as_cwd():
+        with open(j.SETTINGS_FILE, 'w') as save_stream:
+            config.write(save_stream)
+        with pytest.raises(SystemExit) as exc_info:
+            j.initial_setup()
+    assert exc_info.value.code == j.EXIT_ERROR
+    assert f'Incorrect value of {option}: {value}' in capsys.readouterr().out
+
+
+@pytest.mark.parametrize('failing', ['iter_html', 'generate_pdf_from_html_file'])
+def test_export_issue_streamed_removes_temporary_files_on_error(tmpdir, failing):
+    def iter_html(issue, attachments, jira):
+        yield '<h1>ISSUE1</h1>'
+        if failing == 'iter_html':
+            raise RuntimeError('pandoc error')
+
+    settings = j.Settings(export_path='EXP', stream_issues=True)
+    with tmpdir.as_cwd():
+        os.mkdir('EXP')
+        with patch('jira_export.jira_export.iter_html', side_effect=iter_html), \
+                patch('jira_export.jira_export.generate_pdf_from_html_file', side_effect=OSError('wkhtmltopdf error')):
+            with pytest.raises((RuntimeError, OSError)):
+                j.export_issue_streamed(MockIssue(), [], settings, None)
+        assert not [f for f in os.listdir('EXP') if f.endswith('.tmp') or f.endswith('PDF_SOURCE.html')]
+
+
+def test_validate_wkhtmltopdf_exists_provided_path(tmpdir):
+    wkhtmltopdf_path = str(tmpdir.join('wkhtmltopdf'))
+    with pytest.raises(OSError):
+        j.validate_wkhtmltopdf_exists(wkhtmltopdf_path)
+
+    tmpdir.join('wkhtmltopdf').write('')
+    os.chmod(wkhtmltopdf_path, 0o644)
+    with pytest.raises(OSError):
+        j.validate_wkhtmltopdf_exists(wkhtmltopdf_path)
+
+    os.chmod(wkhtmltopdf_path, 0o755)
+    assert j.validate_wkhtmltopdf_exists(wkhtmltopdf_path) == wkhtmltopdf_path
+
+
+def test_initial_setup_incorrect_wkhtmltopdf_path(tmpdir, capsys):
+    with tmpdir.as_cwd():
+        with pytest.raises(SystemExit) as exc_info:
+            j.initial_setup(overrides={'interactive': False, 'wkhtmltopdf_path': 'missing/wkhtmltopdf'})
+    assert exc_info.value.code == j.EXIT_ERROR
+    assert 'missing/wkhtmltopdf' in capsys.readouterr().out
+
+
+def test_main_failed_pdf_is_partial_failure(tmpdir, capsys):
+    jira = MockSearchJira([MockShardIssue(1), MockShardIssue(2)])
+    settings = j.Settings(export_path='EXP', save_to_html=False, interactive=False,
+                          downscale_images=False, skip_unchanged=False, progress_format='json')
+
+    def from_string(html_content, file_path, options, configuration):
+        if 'TEST-2' in file_path:
+            raise IOError('wkhtmltopdf reported an error')
+        with open(file_path, 'w') as save_stream:
+            save_stream.write('PDF')
+
+    with tmpdir.as_cwd():
+        os.mkdir('EXP')
+        with patch('jira_export.jira_export.initial_setup', return_value=settings), \
+                patch('jira_export.jira_export.validate_jira', return_value=jira), \
+                patch('jira_export.jira_export.populate_html', return_value='<p>x</p>'), \
+                patch('jira_export.jira_export.import_pdfkit'), \
+                patch('jira_export.jira_export.configuration', create=True), \
+                patch('jira_export.jira_export.from_string', side_effect=from_string, create=True):
+            with pytest.raises(SystemExit) as exc_info:
+                j.main([])
+        assert os.path.isfile(os.path.join('EXP', 'TEST-2-ERROR.pdf'))
+
+    assert exc_info.value.code == j.EXIT_PARTIAL
+    events = [j.json.loads(line) for line in capsys.readouterr().out.splitlines()]
+    assert [event.get('status') for event in events[:2]] == ['exported', 'failed']
+    assert events[-1]['exported'] == 1 and events[-1]['failed'] == 1
+
+
+def test_initial_setup_non_interactive_in_settings_file_does_not_update_it(tmpdir, monkeypatch):
+    monkeypatch.setenv('XDG_CACHE_HOME', str(tmpdir))
+    monkeypatch.setenv('PYPANDOC_PANDOC', 'pandoc')
+    with tmpdir.as_cwd():
+        with open(j.SETTINGS_FILE, 'w') as save_stream:
+            save_stream.write('[EXPORT_OPTIONS]\ninteractive = False\n')
+        with patch('jira_export.jira_export.probe_toolchain', return_value='pandoc'):
+            settings = j.initial_setup()
+        assert not settings.interactive
+        assert settings.jira_project == j.Settings().jira_project
+        with open(j.SETTINGS_FILE) as load_stream:
+            assert load_stream.read() == '[EXPORT_OPTIONS]\ninteractive = False\n'
+
+
+def test_main_json_progress_from_settings_file_keeps_setup_messages_out_of_stdout(capsys):
+    def initial_setup(settings_file, overrides):
+        print('Program wkhtmltopdf was not found in system.')
+        return j.Settings(interactive=False, progress_format='json')
+
+    with patch('jira_export.jira_export.initial_setup', side_effect=initial_setup), \
+            patch('jira_export.jira_export.validate_jira'), \
+            patch('jira_export.jira_export.export_issues', return_value=j.ExportStats(exported=1)), \
+            patch('jira_export.jira_export.merge_manifests', return_value={'complete': True}):
+        j.main([])
+
+    captured = capsys.readouterr()
+    assert [j.json.loads(line)['event'] for line in captured.out.splitlines()] == ['summary']
+    assert 'wkhtmltopdf' in captured.err
+
+
+def test_validate_jira_unreachable_server_names_settings_file(tmpdir, capsys):
+    with tmpdir.as_cwd():
+        with patch('jira_export.jira_export.authenticate_jira', side_effect=j.socket.gaierror):
+            with pytest.raises(SystemExit) as exc_info:
+                j.validate_jira(j.Settings(export_path='EXP'), 'team_a.ini')
+    assert exc_info.value.code == j.EXIT_ERROR
+    assert 'team_a.ini' in capsys.readouterr().out